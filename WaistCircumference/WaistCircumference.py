@@ -1,11 +1,46 @@
 import os
 import unittest
+import tempfile
 from __main__ import vtk, qt, ctk, slicer
 import Editor
 import EditorLib
 import SimpleITK as sitk
 import sitkUtils as su
 import csv
+import json
+import shutil
+import re
+import glob
+import time
+import socket
+import getpass
+import sqlite3
+import contextlib
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+#
+# Crash-safe file helpers
+#
+
+def syncFile(fileObject):
+  fileObject.flush()
+  os.fsync(fileObject.fileno())
+
+def writeFileAtomically(fileName, writeContents, mode='w'):
+  """call writeContents(fileObject) on a temporary file next to fileName
+  and rename it into place once it is on disk, so that readers only ever
+  see the old or the complete new file
+  """
+  temporaryFileName = fileName + ".tmp"
+  with open(temporaryFileName, mode) as fileObject:
+    writeContents(fileObject)
+    syncFile(fileObject)
+  if os.name == 'nt' and os.path.exists(fileName):
+    # rename does not replace an existing file on Windows
+    os.remove(fileName)
+  os.rename(temporaryFileName, fileName)
 
 #
 # WaistCircumference
@@ -32,6 +67,9 @@ class WaistCircumference:
     with label selections. This will save the data in the display table to the output
     results file, save the mrml scene to a folder named from the master volume's name,
     and then open the next scan in the input "Image List" file.
+    With "Preview while loading" checked, uncompressed MetaImage (.mha, .mhd) and
+    NIfTI (.nii) scans first show every few slices while the full resolution loads;
+    other formats, including NRRD, are loaded at full resolution as before.
     Useful shortcut keys include: 'l' - selects the Editor Level Tracing
     Effect, 'a' - selects the "Apply" button, 'o' - toggles on/off the outline of labels.
     """
@@ -71,6 +109,7 @@ class WaistCircumferenceWidget:
     self.resultsFileDialog = None
     self.imageFileListPath = None
     self.logic = WaistCircumferenceLogic()
+    self.logic.loadingCallback = self.onLoadingChanged
     if not parent:
       self.setup()
       self.parent.show()
@@ -133,6 +172,28 @@ class WaistCircumferenceWidget:
     self.screenshotScaleFactorSliderWidget.setToolTip("Set scale factor for the screen shots.")
     # parametersFormLayout.addRow("Screenshot scale factor", self.screenshotScaleFactorSliderWidget)
 
+    #
+    # check box to share the image list with other operators
+    #
+    self.sharedWorkQueueCheckBox = qt.QCheckBox()
+    self.sharedWorkQueueCheckBox.checked = 0
+    self.sharedWorkQueueCheckBox.setToolTip("If checked, images are leased from a work queue shared by "
+                                            "every operator using the same results file, and results are "
+                                            "written to a per-operator shard of that file.")
+    parametersFormLayout.addRow("Share with other operators", self.sharedWorkQueueCheckBox)
+
+    #
+    # check box to show a decimated preview while the full resolution loads
+    #
+    self.progressiveLoadingCheckBox = qt.QCheckBox()
+    self.progressiveLoadingCheckBox.checked = 0
+    self.progressiveLoadingCheckBox.setToolTip("If checked, a preview with every few slices is shown first "
+                                               "and the full resolution image is loaded in the background. "
+                                               "The label map then only covers the slices around the red "
+                                               "slice and grows as the red slice leaves it. Only "
+                                               "uncompressed .mha, .mhd and .nii files get a preview.")
+    parametersFormLayout.addRow("Preview while loading", self.progressiveLoadingCheckBox)
+
     #
     # Select results file button
     #
@@ -188,17 +249,38 @@ class WaistCircumferenceWidget:
     self.saveButton.enabled = False
     measurementsFormLayout.addRow(self.saveButton)
 
+    #
+    # Merge Button
+    #
+    self.mergeButton = qt.QPushButton("Merge Operator Results")
+    self.mergeButton.toolTip = "Append the new rows of every operator's shard to the results file."
+    self.mergeButton.enabled = False
+    measurementsFormLayout.addRow(self.mergeButton)
+
+    #
+    # QA flags of the last saved image
+    #
+    self.qaLabel = qt.QLabel()
+    self.qaLabel.wordWrap = True
+    measurementsFormLayout.addRow(self.qaLabel)
+
     # connections
     self.selectImageListButton.connect('clicked(bool)', self.onSelectImageList)
     self.selectResultsFileButton.connect('clicked(bool)', self.onSelectResultsFile)
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.saveButton.connect('clicked(bool)', self.onSave)
+    self.mergeButton.connect('clicked(bool)', self.onMergeButton)
     self.helper.masterSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 
     # Add vertical spacer
     self.layout.addStretch(1)
 
   def cleanup(self):
+    self.logic.flushStats()
+    self.logic.releaseLease()
+    # drops a full resolution image still loading in the background
+    self.logic.cancelFullResolution()
+    self.logic.closeLoaderPool()
     self.localEditorWidget.exit()
     self.removeShortcutKeys()
 
@@ -206,17 +288,36 @@ class WaistCircumferenceWidget:
     slicer.mrmlScene.Clear(0)
 
   def onSelect(self):
-    self.applyButton.enabled = self.helper.masterSelector.currentNode()
+    self.applyButton.enabled = self.helper.masterSelector.currentNode() and not self.logic.isLoading()
+
+  def onLoadingChanged(self, loading):
+    """nothing can be measured or saved while the preview is shown
+    """
+    self.applyButton.enabled = not loading
+    self.applyShortcut.enabled = not loading
+    self.saveButton.enabled = False
 
   def onApplyButton(self):
+    if self.logic.isLoading() or not self.logic.hasImageData(self.helper.merge):
+      # the full resolution image and its label map are still loading
+      return False
     self.localEditorWidget.toolsBox.selectEffect("DefaultTool")
     enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     screenshotScaleFactor = int(self.screenshotScaleFactorSliderWidget.value)
     print("Run the algorithm")
-    self.logic.run(self.helper.master, self.helper.merge,
-                   enableScreenshotsFlag, screenshotScaleFactor)
+    if not self.logic.run(self.helper.master, self.helper.merge,
+                          enableScreenshotsFlag, screenshotScaleFactor):
+      qt.QMessageBox.warning(slicer.util.mainWindow(),
+          "Lease expired", "{0} has been leased to another operator after the lease expired. "
+                           "Its results are not saved here and the next image is opened.".format(
+                               self.logic.currentImagePath))
+      self.saveButton.enabled = False
+      self.resetTableModel()
+      self.logic.startNextImage()
+      return False
     self.populateStats()
     self.saveButton.enabled = True
+    return True
 
   def populateStats(self):
     if not self.logic:
@@ -280,6 +381,7 @@ class WaistCircumferenceWidget:
     self.imageFileListPath = fileName
     self.logic.readImageFileList(fileName)
     self.measurementsCollapsibleButton.collapsed = False
+    self.logic.progressiveLoading = self.progressiveLoadingCheckBox.checked
     self.logic.startFirstImage()
 
   def onSelectResultsFile(self):
@@ -296,31 +398,71 @@ class WaistCircumferenceWidget:
 
   def onResultsFileSelected(self, fileName):
     self.resultsFilePath = fileName
-    if os.path.exists(self.resultsFilePath):
-      self.logic.readResultCSV(self.resultsFilePath)
-    else:
+    resultsFileExists = os.path.exists(self.resultsFilePath)
+    if not resultsFileExists:
       self.logic.createNewResultCSV(self.resultsFilePath)
+    if self.sharedWorkQueueCheckBox.checked:
+      # the shared results file is only written, and recovered, by merges
+      # holding the work queue lock
+      self.logic.useSharedWorkQueue(self.resultsFilePath)
+      if resultsFileExists:
+        with self.logic.workQueue.exclusive():
+          self.logic.readResultCSV(self.resultsFilePath)
+    else:
+      self.logic.stopSharedWorkQueue()
+      # replays or rolls back cases left incomplete by a crash
+      self.logic.openResultsJournal(self.resultsFilePath)
+      if resultsFileExists:
+        self.logic.readResultCSV(self.resultsFilePath)
+    self.mergeButton.enabled = self.sharedWorkQueueCheckBox.checked
+    # QA summaries are available before the first case is saved
+    self.logic.loadQualityAssurance(self.resultsFilePath)
 
   def onSave(self):
     """save the label statistics
     """
-    self.onApplyButton() #selects Apply in case it is accidentally not pressed
+    if not self.onApplyButton(): #selects Apply in case it is accidentally not pressed
+      return
     self.logic.takeScreenshot('Slice-label','slice',slicer.qMRMLScreenShotDialog().Red)
     baseDir = os.path.dirname(self.resultsFilePath)
     folderName = self.helper.master.GetName()
-    dirName = os.path.join(baseDir, folderName)
-    if not os.path.exists(dirName):
-      os.mkdir(dirName)
+    dirName = self.logic.getBundleDirName(baseDir, folderName)
+    # the scene bundle is written inside a partial folder and only moved to
+    # its final name once complete. The bundle folder itself keeps the case
+    # name since the scene files are named after it
+    partialDirName = dirName + ".partial"
+    if os.path.exists(partialDirName):
+      shutil.rmtree(partialDirName)
+    bundleDirName = os.path.join(partialDirName, folderName)
+    os.makedirs(bundleDirName)
     l = slicer.app.applicationLogic()
-    l.SaveSceneToSlicerDataBundleDirectory(dirName, None)
+    l.SaveSceneToSlicerDataBundleDirectory(bundleDirName, None)
 
     # saves the csv files to selected folder
-    csvFileName = os.path.join(dirName, "{0}_waist_circumference.csv".format(folderName))
+    csvFileName = os.path.join(bundleDirName, "{0}_waist_circumference.csv".format(folderName))
     self.logic.saveStats(csvFileName)
+    os.rename(bundleDirName, dirName)
+    os.rmdir(partialDirName)
+
+    # the journal commit marks the case as complete
     self.logic.appendStats(self.resultsFilePath)
+    self.showQAFlags(folderName, self.logic.lastQAFlags)
     self.resetTableModel()
     self.logic.startNextImage()
 
+  def showQAFlags(self, imageName, flags):
+    if not flags:
+      self.qaLabel.text = ""
+      return
+    lines = ["QA flags for {0}:".format(imageName)]
+    for flag in flags:
+      lines.append("slice {0}, label {1}: {2}".format(flag["slice"], flag["index"], flag["reason"]))
+    self.qaLabel.text = "\n".join(lines)
+
+  def onMergeButton(self):
+    mergedRows = self.logic.mergeResultShards(self.resultsFilePath)
+    print('Merged {0} rows into {1}'.format(mergedRows, self.resultsFilePath))
+
   def resetTableModel(self):
     self.model = None
 
@@ -337,6 +479,8 @@ class WaistCircumferenceWidget:
       shortcut.setKey( qt.QKeySequence(key) )
       shortcut.connect( 'activated()', callback )
       self.shortcuts.append(shortcut)
+      if key == 'a':
+        self.applyShortcut = shortcut
 
   def removeShortcutKeys(self):
     for shortcut in self.shortcuts:
@@ -382,6 +526,33 @@ class WaistCircumferenceLogic:
     self.helper = None
     self.imageFileList = []
     self.imageFileListCounter = 0
+    self.numberOfThreads = multiprocessing.cpu_count()
+    self.resultsJournal = None
+    # number of saved cases batched into one journal commit
+    self.groupCommitSize = 1
+    self.operatorName = "{0}@{1}".format(getpass.getuser(), socket.gethostname())
+    self.workQueue = None
+    self.currentImagePath = None
+    # leased images whose results are still batched in the journal
+    self.uncommittedImagePaths = []
+    self.progressiveLoading = False
+    # every previewSliceStep-th slice is read for the preview
+    self.previewSliceStep = 4
+    # slices above and below the red slice covered by the label map
+    self.labelSlabHalfWidth = 20
+    self.labelSliceCount = 0
+    # slice of the master volume at slice 0 of the label map
+    self.labelSliceOffset = 0
+    # slices of the master volume when the label map only covers some of them
+    self.masterGeometry = None
+    self.redSliceObservation = None
+    # called with True while a preview is shown instead of the master volume
+    self.loadingCallback = None
+    self.loaderPool = None
+    self.fullResolutionPath = None
+    self.fullResolutionResult = None
+    self.qualityAssurance = None
+    self.lastQAFlags = []
 
   def hasImageData(self,volumeNode):
     """This is a dummy logic method that
@@ -485,23 +656,81 @@ class WaistCircumferenceLogic:
     self.labelStats = {}
     self.labelStats['Labels'] = []
     label3D = su.PullFromSlicer(merge.GetName())
+    imageName = self.helper.master.GetName()
     # currentSlice = self.getCurrentSlice()
-    indexRange = range(0, label3D.GetSize()[2])
-    for sliceIndex in indexRange:
+    for (sliceIndex, labelValue, perimeter) in self.computeSlicePerimeters(label3D):
+      sliceIndex += self.labelSliceOffset
+      self.labelStats["Labels"].append((sliceIndex, labelValue))
+      self.labelStats[sliceIndex, labelValue, "Index"] = labelValue
+      self.labelStats[sliceIndex, labelValue, "Image Name"] = imageName
+      self.labelStats[sliceIndex, labelValue, "Slice"] = sliceIndex
+      self.labelStats[sliceIndex, labelValue, "Circumference (mm)"] = perimeter
+      self.labelStats[sliceIndex, labelValue, "Circumference (in)"] = self.mmToInch(perimeter)
+    print(self.labelStats)
+
+  def getLabeledSliceRange(self, label3D):
+    """return the (first, last + 1) slice indices containing any label,
+    or None when the label map is empty
+    """
+    filter3D = sitk.LabelStatisticsImageFilter()
+    filter3D.Execute(label3D, label3D)
+    sliceRange = None
+    for labelValue in filter3D.GetLabels():
+      if labelValue == 0:
+        continue
+      # bounding box is [xmin, xmax, ymin, ymax, zmin, zmax]
+      boundingBox = filter3D.GetBoundingBox(labelValue)
+      if sliceRange is None:
+        sliceRange = (boundingBox[4], boundingBox[5] + 1)
+      else:
+        sliceRange = (min(sliceRange[0], boundingBox[4]), max(sliceRange[1], boundingBox[5] + 1))
+    return sliceRange
+
+  def computeSlicePerimeters(self, label3D):
+    """return a list of (slice, label, perimeter) tuples ordered by slice and label.
+    The labeled z-range is split into chunks that are computed on a thread pool,
+    and the chunk results are merged back in slice order.
+    """
+    sliceRange = self.getLabeledSliceRange(label3D)
+    if sliceRange is None:
+      return []
+    sliceIndices = range(sliceRange[0], sliceRange[1])
+    numberOfThreads = min(self.numberOfThreads, len(sliceIndices))
+    if numberOfThreads <= 1:
+      # a single chunk leaves the filter to ITK's own multi-threading
+      return self.computeChunkPerimeters((label3D, sliceIndices, 0))
+    # several chunks per thread so that uneven slices do not leave threads idle
+    chunkSize = max(1, len(sliceIndices) // (numberOfThreads * 4))
+    # one ITK thread per filter, the pool already keeps every core busy
+    chunks = [(label3D, sliceIndices[start:start + chunkSize], 1)
+              for start in range(0, len(sliceIndices), chunkSize)]
+    pool = ThreadPool(numberOfThreads)
+    try:
+      # map() returns the chunk results in submission order
+      chunkResults = pool.map(self.computeChunkPerimeters, chunks)
+    finally:
+      pool.close()
+      pool.join()
+    perimeters = []
+    for chunkResult in chunkResults:
+      perimeters.extend(chunkResult)
+    return perimeters
+
+  def computeChunkPerimeters(self, chunk):
+    """chunk is (label3D, sliceIndices, filterThreads), filterThreads 0
+    keeps ITK's default number of threads
+    """
+    label3D, sliceIndices, filterThreads = chunk
+    perimeters = []
+    for sliceIndex in sliceIndices:
       img2D = label3D[:, :, sliceIndex]
       filter2D = sitk.LabelShapeStatisticsImageFilter()
+      if filterThreads:
+        filter2D.SetNumberOfThreads(filterThreads)
       filter2D.Execute(img2D)
-      labels = filter2D.GetLabels()
-      if len(labels) == 0:
-        continue
-      for labelValue in labels:
-        self.labelStats["Labels"].append((sliceIndex, int(labelValue)))
-        self.labelStats[sliceIndex, int(labelValue), "Index"] = int(labelValue)
-        self.labelStats[sliceIndex, int(labelValue), "Image Name"] = self.helper.master.GetName()
-        self.labelStats[sliceIndex, int(labelValue), "Slice"] = sliceIndex
-        self.labelStats[sliceIndex, int(labelValue), "Circumference (mm)"] = filter2D.GetPerimeter(labelValue)
-        self.labelStats[sliceIndex, int(labelValue), "Circumference (in)"] = self.mmToInch(filter2D.GetPerimeter(labelValue))
-        print(self.labelStats)
+      for labelValue in filter2D.GetLabels():
+        perimeters.append((sliceIndex, int(labelValue), filter2D.GetPerimeter(labelValue)))
+    return perimeters
 
   def mmToInch(self, val):
     return val * 0.03937
@@ -513,23 +742,83 @@ class WaistCircumferenceLogic:
         for row in imageList:
           self.imageFileList.append(row.rstrip())
       print(self.imageFileList)
+      if self.workQueue:
+        self.workQueue.addImages(self.imageFileList)
+
+  def useSharedWorkQueue(self, resultsFileName):
+    """lease images from the work queue next to the results file and
+    write this operator's results to its own shard of the results file
+    """
+    self.workQueue = WaistCircumferenceWorkQueue(resultsFileName + ".queue.sqlite")
+    shardFileName = self.getResultsShardFileName(resultsFileName)
+    self.createNewResultCSV(shardFileName)
+    self.openResultsJournal(shardFileName)
+
+  def stopSharedWorkQueue(self):
+    """go back to leasing nothing and writing to the results file itself
+    """
+    if not self.workQueue:
+      return
+    self.flushStats()
+    self.releaseLease()
+    self.workQueue = None
+    self.currentImagePath = None
+    self.resultsJournal = None
+    self.qualityAssurance = None
+
+  def getResultsShardFileName(self, resultsFileName):
+    base, extension = os.path.splitext(resultsFileName)
+    operator = re.sub(r'[^A-Za-z0-9_-]', '_', self.operatorName)
+    return "{0}.shard-{1}{2}".format(base, operator, extension)
 
   def startFirstImage(self):
     self.imageFileListCounter = 0
+    self.leaseImage(resume=True)
     self.importAndCreateVolumes()
 
   def startNextImage(self):
+    # an image still loading in the background is no longer wanted
+    self.cancelFullResolution()
     slicer.mrmlScene.Clear(0)
     self.imageFileListCounter += 1
+    self.leaseImage()
     self.importAndCreateVolumes()
 
+  def leaseImage(self, resume=False):
+    if self.workQueue:
+      self.currentImagePath = self.workQueue.lease(self.operatorName, resume)
+
+  def renewLease(self):
+    """return False when the current image has been leased to another
+    operator, its results must then not be saved by this one
+    """
+    if self.workQueue and self.currentImagePath:
+      return self.workQueue.renew(self.currentImagePath, self.operatorName)
+    return True
+
+  def releaseLease(self):
+    """hand the image back to the work queue when it was not saved
+    """
+    if self.workQueue and self.currentImagePath:
+      self.workQueue.release(self.currentImagePath, self.operatorName)
+
   def checkCounter(self):
+    if self.workQueue:
+      return self.currentImagePath is not None
     return self.imageFileListCounter < len(self.imageFileList)
 
+  def getCurrentImagePath(self):
+    if self.workQueue:
+      return self.currentImagePath
+    return self.imageFileList[self.imageFileListCounter]
+
   def importAndCreateVolumes(self):
     if self.checkCounter():
-      path = self.imageFileList[self.imageFileListCounter]
-      if os.path.exists(path):
+      path = self.getCurrentImagePath()
+      self.labelSliceOffset = 0
+      if os.path.exists(path) and self.progressiveLoading and self.canReadPreview(path):
+        self.loadPreview(path)
+      elif os.path.exists(path):
         self.loadImage(path)
         pattern = self.getNodePatternFromPath(path)
         masterVolumeNode = slicer.util.getNode(pattern=pattern)
@@ -538,6 +827,7 @@ class WaistCircumferenceLogic:
         mergeVolumeNode = slicer.util.getNode(pattern="{0}-label".format(pattern))
         self.helper.setVolumes(masterVolumeNode, mergeVolumeNode)
     else:
+      self.flushStats()
       qt.QMessageBox.warning(slicer.util.mainWindow(),
           "End of image list", "You have reached the end of the image "
                                "list!\n\nYou can now close Slicer")
@@ -552,6 +842,196 @@ class WaistCircumferenceLogic:
     if os.path.exists(path):
       slicer.util.loadVolume(path)
 
+  def canReadPreview(self, path):
+    """only uncompressed MetaImage and NIfTI files can be read a few slices
+    at a time. Other readers, NRRD included, decode the whole file for every
+    slice read, which is slower than loading it at full resolution
+    """
+    lowerPath = path.lower()
+    if lowerPath.endswith('.nii'):
+      return True
+    if lowerPath.endswith(('.mha', '.mhd')):
+      return not self.isCompressedMetaImage(path)
+    return False
+
+  def isCompressedMetaImage(self, path):
+    with open(path, 'rb') as metaImage:
+      for line in metaImage:
+        key, _, value = line.partition('=')
+        if key.strip() == 'CompressedData':
+          return value.strip().lower() == 'true'
+        if key.strip() == 'ElementDataFile':
+          # the last header field
+          break
+    return False
+
+  def readPreviewImage(self, path):
+    """read every previewSliceStep-th slice of the image
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    if reader.GetDimension() != 3 or size[2] <= self.previewSliceStep:
+      return reader.Execute()
+    slices = []
+    for sliceIndex in range(0, size[2], self.previewSliceStep):
+      reader.SetExtractIndex((0, 0, sliceIndex))
+      # a zero size collapses the slice to a 2D image
+      reader.SetExtractSize((size[0], size[1], 0))
+      slices.append(reader.Execute())
+    preview = sitk.JoinSeries(slices)
+    spacing = reader.GetSpacing()
+    preview.SetSpacing((spacing[0], spacing[1], spacing[2] * self.previewSliceStep))
+    preview.SetOrigin(reader.GetOrigin())
+    preview.SetDirection(reader.GetDirection())
+    return preview
+
+  def loadPreview(self, path):
+    """show the preview and read the full resolution image on a
+    background thread, pollFullResolution picks it up when it is ready
+    """
+    pattern = self.getNodePatternFromPath(path)
+    su.PushBackground(self.readPreviewImage(path), "{0}-preview".format(pattern))
+    if not self.loaderPool:
+      self.loaderPool = ThreadPool(1)
+    self.fullResolutionResult = self.loaderPool.apply_async(sitk.ReadImage, (path,))
+    self.setFullResolutionPath(path)
+    self.pollFullResolution(path)
+
+  def setFullResolutionPath(self, path):
+    self.fullResolutionPath = path
+    if self.loadingCallback:
+      self.loadingCallback(self.isLoading())
+
+  def isLoading(self):
+    return self.fullResolutionPath is not None
+
+  def cancelFullResolution(self):
+    self.removeRedSliceObserver()
+    self.masterGeometry = None
+    if self.isLoading():
+      self.setFullResolutionPath(None)
+      # a read in progress cannot be cancelled, the next image gets a new
+      # pool instead of queueing behind it
+      self.closeLoaderPool()
+
+  def closeLoaderPool(self):
+    """let the loader thread exit once its current read, if any, finishes
+    """
+    if self.loaderPool:
+      self.loaderPool.close()
+      self.loaderPool = None
+
+  def pollFullResolution(self, path, msec=200):
+    if path != self.fullResolutionPath:
+      # the operator moved on to another image
+      return
+    if not self.fullResolutionResult.ready():
+      qt.QTimer.singleShot(msec, lambda: self.pollFullResolution(path, msec))
+      return
+    try:
+      self.showFullResolution(path, self.fullResolutionResult.get())
+    finally:
+      self.setFullResolutionPath(None)
+
+  def showFullResolution(self, path, image):
+    pattern = self.getNodePatternFromPath(path)
+    previewVolumeNode = slicer.util.getNode(pattern="{0}-preview".format(pattern))
+    sliceLogic = slicer.app.layoutManager().sliceWidget('Red').sliceLogic()
+    ras = self.getRASFromSliceOffset(sliceLogic)
+    su.PushBackground(image, pattern)
+    masterVolumeNode = slicer.util.getNode(pattern=pattern)
+    slicer.mrmlScene.RemoveNode(previewVolumeNode)
+    self.createSlabMerge(image, pattern, ras)
+    mergeVolumeNode = slicer.util.getNode(pattern="{0}-label".format(pattern))
+    self.setSlabVolumes(masterVolumeNode, mergeVolumeNode)
+
+  def setSlabVolumes(self, masterVolumeNode, mergeVolumeNode):
+    """select the volumes for the Editor like helper.setVolumes, but without
+    its geometry check. The label map only covers some slices of the master,
+    and the check would offer to resample it to the full master
+    """
+    self.helper.master = masterVolumeNode
+    self.helper.merge = mergeVolumeNode
+    # a signal from the selector would run the check again
+    self.helper.masterSelector.blockSignals(True)
+    self.helper.masterSelector.setCurrentNode(masterVolumeNode)
+    self.helper.masterSelector.blockSignals(False)
+    selectionNode = slicer.app.applicationLogic().GetSelectionNode()
+    selectionNode.SetReferenceActiveVolumeID(masterVolumeNode.GetID())
+    selectionNode.SetReferenceActiveLabelVolumeID(mergeVolumeNode.GetID())
+    # keeps the red slice where the operator left it
+    slicer.app.applicationLogic().PropagateVolumeSelection(0)
+
+  def createSlabMerge(self, image, pattern, ras):
+    """create the label map only for the labelSlabHalfWidth slices
+    around the RAS point, growSlabMerge extends it when the red slice
+    leaves it
+    """
+    # a single voxel column keeps the slice geometry of the master volume
+    self.masterGeometry = sitk.Image([1, 1, image.GetSize()[2]], sitk.sitkUInt8)
+    self.masterGeometry.SetOrigin(image.GetOrigin())
+    self.masterGeometry.SetSpacing(image.GetSpacing())
+    self.masterGeometry.SetDirection(image.GetDirection())
+    currentSlice = self.getMasterSlice(ras)
+    firstSlice = max(0, currentSlice - self.labelSlabHalfWidth)
+    lastSlice = min(image.GetSize()[2], currentSlice + self.labelSlabHalfWidth + 1)
+    slabName = "{0}-slab".format(pattern)
+    su.PushBackground(image[:, :, firstSlice:lastSlice], slabName)
+    slabVolumeNode = slicer.util.getNode(pattern=slabName)
+    volumesLogic = slicer.modules.volumes.logic()
+    volumesLogic.CreateAndAddLabelVolume(slicer.mrmlScene, slabVolumeNode, "{0}-label".format(pattern))
+    slicer.mrmlScene.RemoveNode(slabVolumeNode)
+    self.labelSliceOffset = firstSlice
+    self.labelSliceCount = lastSlice - firstSlice
+    self.addRedSliceObserver()
+
+  def getMasterSlice(self, ras):
+    # RAS to LPS flips the first two axes only
+    lps = (-ras[0], -ras[1], ras[2])
+    currentSlice = int(round(self.masterGeometry.TransformPhysicalPointToContinuousIndex(lps)[2]))
+    return min(max(currentSlice, 0), self.masterGeometry.GetSize()[2] - 1)
+
+  def addRedSliceObserver(self):
+    self.removeRedSliceObserver()
+    sliceNode = slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceNode()
+    tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onRedSliceModified)
+    self.redSliceObservation = (sliceNode, tag)
+
+  def removeRedSliceObserver(self):
+    if self.redSliceObservation:
+      sliceNode, tag = self.redSliceObservation
+      sliceNode.RemoveObserver(tag)
+      self.redSliceObservation = None
+
+  def onRedSliceModified(self, caller, event):
+    if not self.masterGeometry or not self.helper.merge:
+      return
+    sliceLogic = slicer.app.layoutManager().sliceWidget('Red').sliceLogic()
+    currentSlice = self.getMasterSlice(self.getRASFromSliceOffset(sliceLogic))
+    if not self.labelSliceOffset <= currentSlice < self.labelSliceOffset + self.labelSliceCount:
+      self.growSlabMerge(currentSlice)
+
+  def growSlabMerge(self, currentSlice):
+    """extend the label map to the labelSlabHalfWidth slices around
+    currentSlice, keeping the labels painted so far
+    """
+    labelName = self.helper.merge.GetName()
+    labels = su.PullFromSlicer(labelName)
+    firstSlice = max(0, min(self.labelSliceOffset, currentSlice - self.labelSlabHalfWidth))
+    lastSlice = min(self.masterGeometry.GetSize()[2],
+                    max(self.labelSliceOffset + self.labelSliceCount, currentSlice + self.labelSlabHalfWidth + 1))
+    grown = sitk.Image([labels.GetSize()[0], labels.GetSize()[1], lastSlice - firstSlice], labels.GetPixelID())
+    grown.SetSpacing(labels.GetSpacing())
+    grown.SetDirection(labels.GetDirection())
+    grown.SetOrigin(self.masterGeometry.TransformIndexToPhysicalPoint((0, 0, firstSlice)))
+    grown = sitk.Paste(grown, labels, labels.GetSize(), [0, 0, 0], [0, 0, self.labelSliceOffset - firstSlice])
+    # overwrites the image of the label map node the Editor works on
+    su.PushToSlicer(grown, labelName, 2, True)
+    self.labelSliceOffset = firstSlice
+    self.labelSliceCount = lastSlice - firstSlice
+
   def createMerge(self):
     try:
       self.helper.createMerge()
@@ -566,10 +1046,14 @@ class WaistCircumferenceLogic:
       #     "Create merge throwing error", 'Exception!\n\n' + str(e) + "\n\nSee Python Console for Stack Trace")
 
   def createNewResultCSV(self, fileName):
-    with open(fileName, 'wb') as csvfile:
+    if os.path.exists(fileName):
+      print('{0} already exists and will not be overwritten'.format(fileName))
+      return
+    def writeHeader(csvfile):
       resultsWriter = csv.writer(csvfile, delimiter=',',
                                  quotechar='"', quoting=csv.QUOTE_ALL)
       resultsWriter.writerow(self.keys)
+    writeFileAtomically(fileName, writeHeader, 'wb')
 
   def readResultCSV(self, fileName):
     self.resultsDict = dict()
@@ -599,20 +1083,167 @@ class WaistCircumferenceLogic:
       csv += line
     return csv
 
+  def getBundleDirName(self, baseDir, folderName):
+    """return the folder for the scene bundle of folderName, numbered so
+    that bundles saved before, e.g. of images with the same name in other
+    folders, are kept
+    """
+    dirName = os.path.join(baseDir, folderName)
+    number = 2
+    while os.path.exists(dirName):
+      dirName = os.path.join(baseDir, "{0}_{1}".format(folderName, number))
+      number += 1
+    return dirName
+
   def saveStats(self,fileName):
-    fp = open(fileName, "w")
-    fp.write(self.statsAsCSV())
-    fp.close()
+    writeFileAtomically(fileName, lambda fp: fp.write(self.statsAsCSV()))
+
+  def openResultsJournal(self, fileName):
+    """return the journal of the results file, recovering any
+    incomplete commit left in it by a previous session
+    """
+    if self.resultsJournal and self.resultsJournal.resultsFileName == fileName:
+      return self.resultsJournal
+    self.flushStats()
+    self.resultsJournal = WaistCircumferenceResultsJournal(fileName, self.groupCommitSize)
+    replayedCases = self.resultsJournal.recover()
+    if replayedCases:
+      print('Replayed incomplete results for: {0}'.format(replayedCases))
+    return self.resultsJournal
 
   def appendStats(self, fileName):
-    with open(fileName, 'a') as csvfile:
-      resultsWriter = csv.writer(csvfile, delimiter=',',
-                                 quotechar='"', quoting=csv.QUOTE_ALL)
-      for (slice, i) in self.labelStats["Labels"]:
-        row = list()
-        for k in self.keys:
-          row.append(self.labelStats[slice, int(i), k])
-        resultsWriter.writerow(row)
+    """record the label statistics of the current image, return False
+    when they are refused because the image was leased to another operator
+    """
+    if not self.renewLease():
+      return False
+    rows = list()
+    for (slice, i) in self.labelStats["Labels"]:
+      row = list()
+      for k in self.keys:
+        row.append(self.labelStats[slice, int(i), k])
+      rows.append(row)
+    cohortName = self.getCohortName(self.getCurrentImagePath())
+    if self.workQueue:
+      resultsFileName = fileName
+      fileName = self.getResultsShardFileName(fileName)
+      self.uncommittedImagePaths.append(self.currentImagePath)
+      # the statistics of the shared results file are updated by one operator at a time
+      with self.workQueue.exclusive():
+        self.qualityAssurance = WaistCircumferenceQualityAssurance(resultsFileName)
+        self.lastQAFlags = self.qualityAssurance.checkCase(cohortName, rows)
+        self.qualityAssurance.save()
+    else:
+      # checked before the case is recorded so that a new QA state does not read it back from the results
+      self.lastQAFlags = self.openQualityAssurance(fileName).checkCase(cohortName, rows)
+    journal = self.openResultsJournal(fileName)
+    journal.record(self.helper.master.GetName(), rows)
+    for flag in self.lastQAFlags:
+      print('QA flag: {0}'.format(flag))
+    if not journal.pendingCases:
+      self.completeLeasedImages()
+      self.saveQualityAssurance()
+    return True
+
+  def flushStats(self):
+    """commit the cases batched in the results journal
+    """
+    if self.resultsJournal:
+      self.resultsJournal.commit()
+    self.completeLeasedImages()
+    self.saveQualityAssurance()
+
+  def openQualityAssurance(self, fileName):
+    if self.qualityAssurance and self.qualityAssurance.resultsFileName == fileName:
+      return self.qualityAssurance
+    self.saveQualityAssurance()
+    self.qualityAssurance = WaistCircumferenceQualityAssurance(fileName)
+    return self.qualityAssurance
+
+  def loadQualityAssurance(self, resultsFileName):
+    """load the QA state of the results file, checking rows appended to it
+    by other means since it was saved
+    """
+    if self.workQueue:
+      with self.workQueue.exclusive():
+        self.qualityAssurance = WaistCircumferenceQualityAssurance(resultsFileName)
+        self.qualityAssurance.save()
+    else:
+      self.openQualityAssurance(resultsFileName).save()
+
+  def saveQualityAssurance(self):
+    # the shared QA state is saved under the work queue lock as each case is checked
+    if self.qualityAssurance and not self.workQueue:
+      self.qualityAssurance.save()
+
+  def getCohortName(self, path):
+    """images are grouped into QA cohorts by the folder containing them
+    """
+    return os.path.basename(os.path.dirname(path))
+
+  def getQASummary(self):
+    """return the running QA statistics of each cohort of the current results file,
+    in shared mode as of the last case saved by this operator
+    """
+    if not self.qualityAssurance:
+      return {}
+    return self.qualityAssurance.summary()
+
+  def completeLeasedImages(self):
+    if self.workQueue:
+      for path in self.uncommittedImagePaths:
+        self.workQueue.complete(path, self.operatorName)
+    self.uncommittedImagePaths = []
+
+  def mergeResultShards(self, resultsFileName):
+    """append the rows added to every operator shard since the last merge
+    to the results file and return the number of merged rows. The byte offset
+    already merged from each shard is kept in <results>.merged.json, which
+    is committed together with the merged rows.
+    """
+    self.flushStats()
+    offsetsFileName = resultsFileName + ".merged.json"
+    base, extension = os.path.splitext(resultsFileName)
+    mergedRows = 0
+    # the work queue lock keeps operators from merging at the same time
+    with self.workQueue.exclusive():
+      shardFileNames = sorted(glob.glob("{0}.shard-*{1}".format(base, extension)))
+      # every shard goes into one commit
+      journal = WaistCircumferenceResultsJournal(resultsFileName, len(shardFileNames) + 1)
+      # an interrupted merge is finished before the offsets are read
+      journal.recover()
+      offsets = dict()
+      if os.path.exists(offsetsFileName):
+        with open(offsetsFileName, 'rb') as offsetsFile:
+          offsets = json.load(offsetsFile)
+      for shardFileName in shardFileNames:
+        shardName = os.path.basename(shardFileName)
+        rows, offsets[shardName] = self.readShardRows(shardFileName, offsets.get(shardName, 0))
+        if rows:
+          journal.record(shardName, rows)
+          mergedRows += len(rows)
+      # the merged rows were checked when their operator saved them
+      qualityAssurance = WaistCircumferenceQualityAssurance(resultsFileName)
+      journal.commit({offsetsFileName: offsets})
+      qualityAssurance.save()
+    return mergedRows
+
+  def readShardRows(self, shardFileName, offset):
+    """return the complete rows of the shard after offset and the offset
+    following the last of them
+    """
+    lines = []
+    with open(shardFileName, 'rb') as shard:
+      shard.seek(offset)
+      if offset == 0:
+        shard.readline() # skips header row
+        offset = shard.tell()
+      line = shard.readline()
+      while line.endswith("\n"):
+        lines.append(line)
+        offset = shard.tell()
+        line = shard.readline()
+    return list(csv.reader(lines, delimiter=',', quotechar='"')), offset
 
   def run(self, master, merge, enableScreenshots=0, screenshotScaleFactor=1):
     """
@@ -624,10 +1255,459 @@ class WaistCircumferenceLogic:
     self.enableScreenshots = enableScreenshots
     self.screenshotScaleFactor = screenshotScaleFactor
 
+    # the operator is still working on the image
+    if not self.renewLease():
+      return False
+
     self.calculateCircumference(merge)
 
     return True
 
+#
+# WaistCircumferenceResultsJournal
+#
+
+class WaistCircumferenceResultsJournal:
+  """Write-ahead journal for the shared results csv file.
+  Every recorded case is appended to <results>.journal right away with the
+  size of the results file. A commit of the batched cases appends a "commit"
+  record and syncs the journal, then appends the rows to the results file
+  and removes the journal once they are on disk. Side files, such as the
+  merged shard offsets, can be committed together with the rows; they are
+  kept in the "commit" record and written after them. On recovery a journal
+  that is still there is rolled back by truncating the results file to the
+  recorded size and all of its complete case records are replayed, so every
+  case is either completely in the results file or not at all. Batching
+  several cases per commit (groupCommitSize) saves the fsyncs of each case.
+  """
+  def __init__(self, resultsFileName, groupCommitSize=1):
+    self.resultsFileName = resultsFileName
+    self.journalFileName = resultsFileName + ".journal"
+    self.groupCommitSize = max(1, groupCommitSize)
+    self.pendingCases = []
+
+  def record(self, caseName, rows):
+    # synced with the next commit, the results file only changes on commits
+    self.appendRecord({"op": "case", "offset": os.path.getsize(self.resultsFileName),
+                       "case": caseName, "rows": rows}, sync=False)
+    self.pendingCases.append({"case": caseName, "rows": rows})
+    if len(self.pendingCases) >= self.groupCommitSize:
+      self.commit()
+
+  def commit(self, sideFiles=None):
+    """sideFiles maps file names to json contents written with the rows
+    """
+    if not self.pendingCases and not sideFiles:
+      return
+    offset = os.path.getsize(self.resultsFileName)
+    self.appendRecord({"op": "commit", "offset": offset, "sideFiles": sideFiles or {}}, sync=True)
+    self.writeCases(offset, self.pendingCases)
+    self.writeSideFiles(sideFiles or {})
+    # the results file is synced, removing the journal marks the commit as
+    # complete and a removal lost in a crash only causes an identical replay
+    os.remove(self.journalFileName)
+    self.pendingCases = []
+
+  def appendRecord(self, record, sync):
+    with open(self.journalFileName, 'ab') as journal:
+      journal.write(json.dumps(record) + "\n")
+      if sync:
+        syncFile(journal)
+
+  def writeCases(self, offset, cases):
+    with open(self.resultsFileName, 'r+b') as csvfile:
+      csvfile.seek(offset)
+      csvfile.truncate()
+      resultsWriter = csv.writer(csvfile, delimiter=',',
+                                 quotechar='"', quoting=csv.QUOTE_ALL)
+      for case in cases:
+        resultsWriter.writerows(case["rows"])
+      syncFile(csvfile)
+
+  def writeSideFiles(self, sideFiles):
+    for fileName, contents in sideFiles.items():
+      writeFileAtomically(fileName, lambda sideFile: json.dump(contents, sideFile), 'wb')
+
+  def recover(self):
+    """finish the last commit if it was interrupted and return the
+    names of the replayed cases
+    """
+    if not os.path.exists(self.journalFileName):
+      return []
+    offset = None
+    cases = []
+    sideFiles = {}
+    with open(self.journalFileName, 'rb') as journal:
+      for line in journal:
+        if not line.endswith("\n"):
+          # torn write at the end of the journal, nothing after it reached the results
+          break
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        if offset is None:
+          offset = record["offset"]
+        if record["op"] == "case":
+          cases.append(record)
+        elif record["op"] == "commit":
+          sideFiles = record["sideFiles"]
+    replayedCases = []
+    if offset is not None and os.path.exists(self.resultsFileName):
+      self.writeCases(offset, cases)
+      self.writeSideFiles(sideFiles)
+      replayedCases = [case["case"] for case in cases]
+    # the results file is consistent again
+    os.remove(self.journalFileName)
+    return replayedCases
+
+#
+# WaistCircumferenceQuantileSketch
+#
+
+class WaistCircumferenceQuantileSketch:
+  """Estimate of one quantile in constant memory with the P-square
+  algorithm (Jain and Chlamtac, 1985): five markers track the minimum,
+  the maximum, the quantile and the quantiles halfway to it.
+  """
+  def __init__(self, quantile):
+    self.quantile = quantile
+    self.heights = []
+    self.positions = [1, 2, 3, 4, 5]
+    self.desiredPositions = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+    self.increments = [0, quantile / 2.0, quantile, (1 + quantile) / 2.0, 1]
+
+  def add(self, value):
+    heights = self.heights
+    if len(heights) < 5:
+      heights.append(value)
+      heights.sort()
+      return
+    if value < heights[0]:
+      heights[0] = value
+      cell = 0
+    elif value >= heights[4]:
+      heights[4] = value
+      cell = 3
+    else:
+      cell = max(i for i in range(4) if heights[i] <= value)
+    for i in range(cell + 1, 5):
+      self.positions[i] += 1
+    for i in range(5):
+      self.desiredPositions[i] += self.increments[i]
+    positions = self.positions
+    for i in range(1, 4):
+      offset = self.desiredPositions[i] - positions[i]
+      if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+         (offset <= -1 and positions[i - 1] - positions[i] < -1):
+        step = 1 if offset > 0 else -1
+        height = self.parabolic(i, step)
+        if not heights[i - 1] < height < heights[i + 1]:
+          height = self.linear(i, step)
+        heights[i] = height
+        positions[i] += step
+
+  def parabolic(self, i, step):
+    n, q = self.positions, self.heights
+    return q[i] + step / float(n[i + 1] - n[i - 1]) * (
+        (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) +
+        (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+  def linear(self, i, step):
+    n, q = self.positions, self.heights
+    return q[i] + step * (q[i + step] - q[i]) / float(n[i + step] - n[i])
+
+  def value(self):
+    if not self.heights:
+      return None
+    if len(self.heights) < 5:
+      return self.heights[int(round(self.quantile * (len(self.heights) - 1)))]
+    return self.heights[2]
+
+  def toDict(self):
+    return {"quantile": self.quantile, "heights": self.heights,
+            "positions": self.positions, "desiredPositions": self.desiredPositions}
+
+  @classmethod
+  def fromDict(cls, state):
+    sketch = cls(state["quantile"])
+    sketch.heights = state["heights"]
+    sketch.positions = state["positions"]
+    sketch.desiredPositions = state["desiredPositions"]
+    return sketch
+
+#
+# WaistCircumferenceQualityAssurance
+#
+
+class WaistCircumferenceQualityAssurance:
+  """Running QA statistics of the circumferences written to a results file.
+  Each cohort keeps a Welford mean and variance and quantile sketches that
+  are updated as cases are saved, and every row is checked against them.
+  The statistics are kept in <results>.qa.json together with the size of
+  the results file they cover, so that only rows appended by other means
+  since the last save are read again. Those rows, and the rows found when
+  no statistics exist yet, are checked against and added to the "all"
+  cohort only. Flags are counted per cohort and appended to
+  <results>.qa_flags.csv.
+  """
+  quantiles = (0.05, 0.5, 0.95)
+
+  def __init__(self, resultsFileName):
+    self.resultsFileName = resultsFileName
+    self.stateFileName = resultsFileName + ".qa.json"
+    self.flagsFileName = resultsFileName + ".qa_flags.csv"
+    # rows outside this range are most likely tiny labels or unit mix-ups
+    self.minimumCircumference = 300.0
+    self.maximumCircumference = 2500.0
+    # largest difference between the (in) column and the converted (mm) column
+    self.inchTolerance = 0.05
+    # cohort samples needed before outliers are flagged
+    self.minimumSamples = 20
+    self.outlierZScore = 4.0
+    self.cohorts = {}
+    self.resultsOffset = 0
+    self.load()
+
+  def load(self):
+    if os.path.exists(self.stateFileName):
+      with open(self.stateFileName, 'rb') as stateFile:
+        state = json.load(stateFile)
+      self.resultsOffset = state["resultsOffset"]
+      for name, cohort in state["cohorts"].items():
+        cohort["sketches"] = [WaistCircumferenceQuantileSketch.fromDict(sketch) for sketch in cohort["sketches"]]
+        self.cohorts[name] = cohort
+    if not os.path.exists(self.resultsFileName):
+      return
+    if os.path.getsize(self.resultsFileName) < self.resultsOffset:
+      # the results file was replaced, the statistics no longer describe it
+      self.cohorts = {}
+      self.resultsOffset = 0
+    self.readResultsTail()
+
+  def readResultsTail(self):
+    with open(self.resultsFileName, 'rb') as csvfile:
+      csvfile.seek(self.resultsOffset)
+      if self.resultsOffset == 0:
+        csvfile.readline() # skips header row
+      for row in csv.reader(csvfile, delimiter=',', quotechar='"'):
+        self.checkRows("all", [row])
+    self.resultsOffset = os.path.getsize(self.resultsFileName)
+
+  def getCohort(self, name):
+    if name not in self.cohorts:
+      self.cohorts[name] = {"count": 0, "mean": 0.0, "m2": 0.0, "flagged": 0,
+                            "sketches": [WaistCircumferenceQuantileSketch(q) for q in self.quantiles]}
+    return self.cohorts[name]
+
+  def addMeasurement(self, name, value):
+    cohort = self.getCohort(name)
+    cohort["count"] += 1
+    delta = value - cohort["mean"]
+    cohort["mean"] += delta / cohort["count"]
+    cohort["m2"] += delta * (value - cohort["mean"])
+    for sketch in cohort["sketches"]:
+      sketch.add(value)
+
+  def standardDeviation(self, cohort):
+    if cohort["count"] < 2:
+      return 0.0
+    return math.sqrt(cohort["m2"] / (cohort["count"] - 1))
+
+  def checkCase(self, name, rows):
+    """check the rows of one saved case, add the plausible ones to the
+    statistics of the cohort and return the flags raised
+    """
+    if not rows:
+      return self.recordFlags(name, [{"image": None, "slice": None, "index": None,
+                                      "reason": "no labeled slices"}])
+    return self.checkRows(name, rows) + self.checkSlices(name, rows)
+
+  def checkSlices(self, name, rows):
+    """flag slices missing between the labeled slices of a case and slices
+    with a different number of labels than the others
+    """
+    labelsPerSlice = {}
+    for row in rows:
+      try:
+        sliceIndex = int(row[2])
+      except (ValueError, TypeError, IndexError):
+        continue # flagged by checkRows
+      labelsPerSlice[sliceIndex] = labelsPerSlice.get(sliceIndex, 0) + 1
+    imageName = rows[0][1]
+    flags = []
+    labeledSlices = sorted(labelsPerSlice)
+    for previous, following in zip(labeledSlices, labeledSlices[1:]):
+      if following - previous > 1:
+        flags.append({"image": imageName, "slice": previous + 1, "index": None,
+                      "reason": "slices {0} to {1} are missing between labeled slices".format(
+                          previous + 1, following - 1)})
+    if len(set(labelsPerSlice.values())) > 1:
+      flags.append({"image": imageName, "slice": None, "index": None,
+                    "reason": "labels per slice differ: {0}".format(
+                        ", ".join("{0}: {1}".format(k, labelsPerSlice[k]) for k in labeledSlices))})
+    return self.recordFlags(name, flags)
+
+  def checkRows(self, name, rows):
+    flags = []
+    for row in rows:
+      try:
+        index, imageName, sliceIndex, circumference, inches = row
+        circumference = float(circumference)
+        inches = float(inches)
+      except (ValueError, TypeError):
+        flags.append({"image": None, "slice": None, "index": None,
+                      "reason": "malformed row {0}".format(row)})
+        continue
+      reasons = self.checkMeasurement(name, circumference, inches)
+      for reason in reasons:
+        flags.append({"image": imageName, "slice": sliceIndex, "index": index, "reason": reason})
+      if not reasons:
+        self.addMeasurement(name, circumference)
+        if name != "all":
+          self.addMeasurement("all", circumference)
+    return self.recordFlags(name, flags)
+
+  def recordFlags(self, name, flags):
+    if not flags:
+      return flags
+    for flag in flags:
+      flag["cohort"] = name
+    self.getCohort(name)["flagged"] += len(flags)
+    writeHeader = not os.path.exists(self.flagsFileName)
+    with open(self.flagsFileName, 'ab') as csvfile:
+      flagsWriter = csv.writer(csvfile, delimiter=',',
+                               quotechar='"', quoting=csv.QUOTE_ALL)
+      if writeHeader:
+        flagsWriter.writerow(("Cohort", "Image Name", "Slice", "Index", "Reason"))
+      for flag in flags:
+        flagsWriter.writerow((name, flag["image"], flag["slice"], flag["index"], flag["reason"]))
+    return flags
+
+  def checkMeasurement(self, name, circumference, inches):
+    reasons = []
+    if abs(inches - circumference * 0.03937) > self.inchTolerance:
+      reasons.append("Circumference (in) {0} does not match Circumference (mm) {1}".format(inches, circumference))
+    if circumference < self.minimumCircumference:
+      reasons.append("circumference {0} mm is below {1} mm".format(circumference, self.minimumCircumference))
+    elif circumference > self.maximumCircumference:
+      reasons.append("circumference {0} mm is above {1} mm".format(circumference, self.maximumCircumference))
+    # compare with the cohort, or with every image while the cohort is small
+    cohort = self.getCohort(name)
+    if cohort["count"] < self.minimumSamples:
+      cohort = self.getCohort("all")
+    if cohort["count"] >= self.minimumSamples:
+      median = cohort["sketches"][self.quantiles.index(0.5)].value()
+      if median and abs(circumference * 25.4 / median - 1) < 0.2:
+        reasons.append("circumference {0} mm is about the median in inches".format(circumference))
+      elif median and abs(circumference / 25.4 / median - 1) < 0.2:
+        reasons.append("circumference {0} mm is about 25.4 times the median".format(circumference))
+      standardDeviation = self.standardDeviation(cohort)
+      if standardDeviation > 0 and abs(circumference - cohort["mean"]) > self.outlierZScore * standardDeviation:
+        reasons.append("circumference {0} mm is more than {1} standard deviations from the mean {2:.1f} mm".format(
+            circumference, self.outlierZScore, cohort["mean"]))
+    return reasons
+
+  def summary(self):
+    summary = {}
+    for name, cohort in self.cohorts.items():
+      summary[name] = {"count": cohort["count"], "mean": cohort["mean"],
+                       "standardDeviation": self.standardDeviation(cohort),
+                       "flagged": cohort["flagged"]}
+      for sketch in cohort["sketches"]:
+        summary[name]["quantile {0}".format(sketch.quantile)] = sketch.value()
+    return summary
+
+  def save(self):
+    if os.path.exists(self.resultsFileName):
+      self.resultsOffset = os.path.getsize(self.resultsFileName)
+    cohorts = {}
+    for name, cohort in self.cohorts.items():
+      cohorts[name] = dict(cohort)
+      cohorts[name]["sketches"] = [sketch.toDict() for sketch in cohort["sketches"]]
+    state = {"resultsOffset": self.resultsOffset, "cohorts": cohorts}
+    writeFileAtomically(self.stateFileName, lambda stateFile: json.dump(state, stateFile), 'wb')
+
+#
+# WaistCircumferenceWorkQueue
+#
+
+class WaistCircumferenceWorkQueue:
+  """Image work queue shared by several operators in an SQLite database.
+  An operator leases the next pending image for leaseSeconds; an operator
+  resuming after a restart gets back the image it still holds, and expired
+  leases are handed to other operators. Every lease is taken
+  inside an immediate transaction so that two operators never get the same
+  image.
+  """
+  def __init__(self, databaseFileName, leaseSeconds=3600):
+    self.databaseFileName = databaseFileName
+    self.leaseSeconds = leaseSeconds
+    # autocommit mode, transactions are started explicitly
+    self.connection = sqlite3.connect(databaseFileName, timeout=60, isolation_level=None)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS images ("
+                            "position INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "path TEXT UNIQUE NOT NULL, "
+                            "status TEXT NOT NULL DEFAULT 'pending', "
+                            "operator TEXT, "
+                            "leaseExpires REAL)")
+
+  @contextlib.contextmanager
+  def exclusive(self):
+    self.connection.execute("BEGIN IMMEDIATE")
+    try:
+      yield self.connection
+    except BaseException:
+      self.connection.execute("ROLLBACK")
+      raise
+    self.connection.execute("COMMIT")
+
+  def addImages(self, paths):
+    with self.exclusive() as connection:
+      connection.executemany("INSERT OR IGNORE INTO images (path) VALUES (?)",
+                             [(path,) for path in paths if path])
+
+  def lease(self, operator, resume=False):
+    """return the path of the image leased to operator, or None when
+    every image is done or leased by somebody else. With resume, an image
+    the operator already holds is returned first.
+    """
+    now = time.time()
+    with self.exclusive() as connection:
+      row = None
+      if resume:
+        row = connection.execute("SELECT path FROM images WHERE status = 'leased' AND operator = ? "
+                                 "ORDER BY position LIMIT 1", (operator,)).fetchone()
+      if row is None:
+        row = connection.execute("SELECT path FROM images WHERE status = 'pending' "
+                                 "OR (status = 'leased' AND leaseExpires < ?) "
+                                 "ORDER BY position LIMIT 1", (now,)).fetchone()
+      if row is None:
+        return None
+      connection.execute("UPDATE images SET status = 'leased', operator = ?, leaseExpires = ? "
+                         "WHERE path = ?", (operator, now + self.leaseSeconds, row[0]))
+    return row[0]
+
+  def complete(self, path, operator):
+    with self.exclusive() as connection:
+      connection.execute("UPDATE images SET status = 'done', leaseExpires = NULL "
+                         "WHERE path = ? AND operator = ?", (path, operator))
+
+  def renew(self, path, operator):
+    """extend the lease of operator on path, return False if the image
+    is no longer leased to operator
+    """
+    with self.exclusive() as connection:
+      cursor = connection.execute("UPDATE images SET leaseExpires = ? "
+                                  "WHERE path = ? AND operator = ? AND status = 'leased'",
+                                  (time.time() + self.leaseSeconds, path, operator))
+    return cursor.rowcount > 0
+
+  def release(self, path, operator):
+    with self.exclusive() as connection:
+      connection.execute("UPDATE images SET status = 'pending', operator = NULL, leaseExpires = NULL "
+                         "WHERE path = ? AND operator = ? AND status = 'leased'", (path, operator))
+
 class WaistCircumferenceTest(unittest.TestCase):
   """
   This is the test case for your scripted module.
@@ -664,6 +1744,12 @@ class WaistCircumferenceTest(unittest.TestCase):
     self.test_WaistCircumference1()
     self.test_WaistCircumference2()
     self.test_WaistCircumference3()
+    self.test_ParallelSlicePerimeters()
+    self.test_ProgressiveLoading()
+    self.test_ResultsJournal()
+    self.test_WorkQueue()
+    self.test_MergeResultShards()
+    self.test_QualityAssurance()
 
   def test_WaistCircumference1(self):
 
@@ -765,3 +1851,194 @@ class WaistCircumferenceTest(unittest.TestCase):
       import traceback
       traceback.print_exc()
       self.delayDisplay('Test caused exception!\n' + str(e))
+
+  def test_ParallelSlicePerimeters(self):
+    self.delayDisplay("Starting parallel slice test")
+    label3D = sitk.Image([32, 32, 40], sitk.sitkUInt8)
+    for z in range(2, 38):
+      for y in range(8, 20):
+        for x in range(8, 12 + z % 10):
+          label3D.SetPixel(x, y, z, 1 + z % 3)
+        if z % 2 == 0:
+          for x in range(22, 27):
+            label3D.SetPixel(x, y, z, 5)
+    logic = WaistCircumferenceLogic()
+    logic.numberOfThreads = 1
+    serial = logic.computeSlicePerimeters(label3D)
+    # 36 labeled slices in chunks of 3 give 12 chunks for 3 threads
+    logic.numberOfThreads = 3
+    parallel = logic.computeSlicePerimeters(label3D)
+    self.assertEqual(len(serial), 36 + 18)
+    self.assertEqual(serial[0][0], 2)
+    self.assertEqual(parallel, serial)
+    self.delayDisplay("Parallel slice test passed!")
+
+  def test_ProgressiveLoading(self):
+    self.delayDisplay("Starting progressive loading test")
+    imagePath = os.path.join(tempfile.mkdtemp(), "progressive.mha")
+    sitk.WriteImage(sitk.Image([40, 40, 120], sitk.sitkInt16), imagePath)
+    logic = slicer.modules.WaistCircumferenceWidget.logic
+    self.assertTrue(logic.canReadPreview(imagePath))
+    logic.progressiveLoading = True
+    logic.imageFileList = [imagePath]
+    try:
+      logic.startFirstImage()
+      timeout = time.time() + 60
+      while logic.isLoading() and time.time() < timeout:
+        slicer.app.processEvents()
+      self.assertFalse(logic.isLoading())
+      self.assertTrue(logic.labelSliceCount <= 2 * logic.labelSlabHalfWidth + 1)
+
+      # scrolling the red slice outside the label map grows it
+      targetSlice = 110 if logic.labelSliceOffset < 60 else 5
+      sliceLogic = slicer.app.layoutManager().sliceWidget('Red').sliceLogic()
+      sliceLogic.SetSliceOffset(targetSlice)
+      self.assertTrue(logic.labelSliceOffset <= targetSlice < logic.labelSliceOffset + logic.labelSliceCount)
+
+      # paint a square on that slice and check the master slice is reported
+      labelName = logic.helper.merge.GetName()
+      labels = su.PullFromSlicer(labelName)
+      for y in range(10, 20):
+        for x in range(10, 20):
+          labels.SetPixel(x, y, targetSlice - logic.labelSliceOffset, 1)
+      su.PushToSlicer(labels, labelName, 2, True)
+      logic.calculateCircumference(logic.helper.merge)
+      self.assertEqual(logic.labelStats["Labels"], [(targetSlice, 1)])
+    finally:
+      logic.progressiveLoading = False
+    self.delayDisplay("Progressive loading test passed!")
+
+  def test_ResultsJournal(self):
+    self.delayDisplay("Starting results journal test")
+    resultsFileName = os.path.join(tempfile.mkdtemp(), "results.csv")
+    logic = WaistCircumferenceLogic()
+    logic.createNewResultCSV(resultsFileName)
+    journal = WaistCircumferenceResultsJournal(resultsFileName, 2)
+    journal.record("a", [[1, "a", 3, 900.0, 35.4]])
+    # the batched case is in the journal before it is committed
+    self.assertTrue(os.path.exists(journal.journalFileName))
+    journal.record("b", [[1, "b", 4, 800.0, 31.5]])
+    self.assertFalse(os.path.exists(journal.journalFileName))
+
+    # a crash after the "commit" record, with half a row in the results file
+    # and a torn record behind it
+    journal.record("c", [[1, "c", 5, 850.0, 33.5]])
+    journal.appendRecord({"op": "commit", "offset": os.path.getsize(resultsFileName),
+                          "sideFiles": {}}, sync=True)
+    with open(journal.journalFileName, 'ab') as journalFile:
+      journalFile.write('{"op": "case", "off')
+    with open(resultsFileName, 'ab') as csvfile:
+      csvfile.write('"1","c"')
+    self.assertEqual(WaistCircumferenceResultsJournal(resultsFileName).recover(), ["c"])
+    self.assertFalse(os.path.exists(journal.journalFileName))
+
+    # a crash before the batch was committed
+    WaistCircumferenceResultsJournal(resultsFileName, 2).record("d", [[1, "d", 6, 870.0, 34.3]])
+    self.assertEqual(WaistCircumferenceResultsJournal(resultsFileName).recover(), ["d"])
+    with open(resultsFileName, 'rb') as csvfile:
+      rows = list(csv.reader(csvfile))
+    self.assertEqual([row[1] for row in rows], ["Image Name", "a", "b", "c", "d"])
+    self.delayDisplay("Results journal test passed!")
+
+  def test_WorkQueue(self):
+    self.delayDisplay("Starting work queue test")
+    databaseFileName = os.path.join(tempfile.mkdtemp(), "results.csv.queue.sqlite")
+    queue = WaistCircumferenceWorkQueue(databaseFileName)
+    queue.addImages(["a", "b", "c"])
+    # a second connection, as used by another operator
+    otherQueue = WaistCircumferenceWorkQueue(databaseFileName)
+    leased = [queue.lease("alice"), otherQueue.lease("bob"), queue.lease("alice")]
+    self.assertEqual(sorted(leased), ["a", "b", "c"])
+    self.assertEqual(otherQueue.lease("bob"), None)
+    self.assertEqual(otherQueue.lease("bob", resume=True), "b")
+
+    # an expired lease goes to the next operator and can no longer be renewed
+    queue.connection.execute("UPDATE images SET leaseExpires = 0 WHERE path = 'a'")
+    self.assertEqual(otherQueue.lease("bob"), "a")
+    self.assertFalse(queue.renew("a", "alice"))
+    self.assertTrue(otherQueue.renew("a", "bob"))
+
+    # results of an image leased to somebody else are refused
+    resultsFileName = os.path.join(os.path.dirname(databaseFileName), "results.csv")
+    logic = WaistCircumferenceLogic()
+    logic.operatorName = "alice"
+    logic.createNewResultCSV(resultsFileName)
+    logic.useSharedWorkQueue(resultsFileName)
+    logic.currentImagePath = "a"
+    self.assertFalse(logic.appendStats(resultsFileName))
+    self.assertEqual(logic.uncommittedImagePaths, [])
+    with open(logic.getResultsShardFileName(resultsFileName), 'rb') as csvfile:
+      self.assertEqual(len(list(csv.reader(csvfile))), 1)
+
+    queue.complete("c", "alice")
+    otherQueue.release("b", "bob")
+    self.assertEqual(queue.lease("alice"), "b")
+    self.assertEqual(queue.lease("alice"), None)
+    self.delayDisplay("Work queue test passed!")
+
+  def test_MergeResultShards(self):
+    self.delayDisplay("Starting merge test")
+    resultsFileName = os.path.join(tempfile.mkdtemp(), "results.csv")
+    logic = WaistCircumferenceLogic()
+    logic.createNewResultCSV(resultsFileName)
+    logic.useSharedWorkQueue(resultsFileName)
+    shard = WaistCircumferenceResultsJournal(logic.getResultsShardFileName(resultsFileName))
+    shard.record("a", [[1, "a", 3, 900.0, 35.4]])
+    self.assertEqual(logic.mergeResultShards(resultsFileName), 1)
+    self.assertEqual(logic.mergeResultShards(resultsFileName), 0)
+
+    # a merge interrupted after its "commit" record is finished, offsets included
+    shard.record("b", [[1, "b", 4, 800.0, 31.5]])
+    journal = WaistCircumferenceResultsJournal(resultsFileName)
+    rows, offset = logic.readShardRows(shard.resultsFileName, 0)
+    journal.appendRecord({"op": "case", "offset": os.path.getsize(resultsFileName),
+                          "case": "shard", "rows": rows[1:]}, sync=False)
+    journal.appendRecord({"op": "commit", "offset": os.path.getsize(resultsFileName),
+                          "sideFiles": {resultsFileName + ".merged.json":
+                                        {os.path.basename(shard.resultsFileName): offset}}}, sync=True)
+    self.assertEqual(logic.mergeResultShards(resultsFileName), 0)
+    with open(resultsFileName, 'rb') as csvfile:
+      rows = list(csv.reader(csvfile))
+    self.assertEqual([row[1] for row in rows], ["Image Name", "a", "b"])
+    self.delayDisplay("Merge test passed!")
+
+  def test_QualityAssurance(self):
+    self.delayDisplay("Starting QA test")
+    resultsFileName = os.path.join(tempfile.mkdtemp(), "results.csv")
+    logic = WaistCircumferenceLogic()
+    logic.createNewResultCSV(resultsFileName)
+    qualityAssurance = WaistCircumferenceQualityAssurance(resultsFileName)
+    for i in range(30):
+      circumference = 800.0 + 10 * i
+      flags = qualityAssurance.checkCase("cohort", [[1, "image{0}".format(i), 5, circumference,
+                                                     logic.mmToInch(circumference)]])
+      self.assertEqual(flags, [])
+    flags = qualityAssurance.checkCase("cohort", [[1, "inches", 5, 40.0, logic.mmToInch(40.0)]])
+    self.assertTrue(flags)
+    # slices 7 and 8 are missing and slice 6 has two labels
+    flags = qualityAssurance.checkCase("cohort", [[1, "gaps", 5, 900.0, logic.mmToInch(900.0)],
+                                                  [1, "gaps", 6, 900.0, logic.mmToInch(900.0)],
+                                                  [2, "gaps", 6, 910.0, logic.mmToInch(910.0)],
+                                                  [1, "gaps", 9, 900.0, logic.mmToInch(900.0)]])
+    self.assertEqual(len(flags), 2)
+    self.assertEqual(flags[0]["slice"], 7)
+    qualityAssurance.save()
+
+    # rows appended by other means are checked when the state is loaded again
+    with open(resultsFileName, 'ab') as csvfile:
+      csvfile.write('"1","mixed","5","950.0","950.0"\n\n"1","short"\n"1","good","5","950.0","37.4"\n')
+    loaded = WaistCircumferenceQualityAssurance(resultsFileName)
+    summary = qualityAssurance.summary()
+    self.assertEqual(loaded.summary()["cohort"], summary["cohort"])
+    self.assertEqual(loaded.summary()["all"]["count"], summary["all"]["count"] + 1)
+    self.assertEqual(loaded.summary()["all"]["flagged"], 3)
+    with open(loaded.flagsFileName, 'rb') as csvfile:
+      flaggedImages = [row[1] for row in csv.reader(csvfile)]
+    self.assertTrue("mixed" in flaggedImages)
+    self.assertTrue("inches" in flaggedImages)
+
+    # the summary is available after a restart, before anything is saved
+    restarted = WaistCircumferenceLogic()
+    restarted.loadQualityAssurance(resultsFileName)
+    self.assertEqual(restarted.getQASummary()["cohort"], summary["cohort"])
+    self.delayDisplay("QA test passed!")